@@ -98,19 +98,35 @@ Copyright (C) 2017 Bennett Helm
 
 Note that the caption can be formatted text in markdown.
 
+Each figure is typeset once, into a PDF kept in `IMAGE_PATH`. For output
+formats other than LaTeX, a PNG (or, with `figure-filetype: svg` in the YAML
+header, an SVG) is made from that PDF and kept next to it.
+
 """
 
 
-from pandocfilters import json, sys, walk, elt, stringify,\
-    RawInline, Para, Plain, Image, Str
-from os import path, mkdir, chdir, getcwd
+from pandocfilters import json, sys, elt, RawInline, Para, Plain, Image, Str
+from pandocfilters import stringify as plain_stringify
+from os import path, mkdir, makedirs, chdir, getcwd, stat, environ, rename
+from io import open as io_open
+from re import compile as re_compile, IGNORECASE
 from shutil import copyfile, rmtree
 from sys import getfilesystemencoding, stderr
 from subprocess import call, Popen, PIPE
 from hashlib import sha1
+from time import sleep, time
+try:
+    from sys import intern
+except ImportError:  # Python 2 (whose builtin `intern` rejects `unicode`)
+    intern = None
 
 IMAGE_PATH = path.expanduser('~/tmp/pandoc/Figures')
+BIBLIOGRAPHY_PATH = path.expanduser('~/tmp/pandoc/Bibliographies')
 DEFAULT_FONT = 'fbb'
+WATCH_INTERVAL = 0.5  # Seconds between checks for changed files
+WATCH_DEBOUNCE = 0.3  # Seconds without changes before rebuilding
+WATCH_FORMATS = {'.pdf': 'latex', '.tex': 'latex', '.html': 'html5',
+                 '.docx': 'docx'}
 INLINE_TAG_STACK = []
 BLOCK_COMMENT = False
 INLINE_COMMENT = False
@@ -119,6 +135,22 @@ INLINE_HIGHLIGHT = False
 INLINE_FONT_COLOR_STACK = ['black']
 USED_BOX = False
 DRAFT = False
+CAPTIONS = {}  # Markdown caption -> formatted inlines, see `format_caption`
+# Set COMMENT_FILTER_COMPACT=1 to hold the document as `Node`s rather than
+# dicts, which takes much less memory for large documents.
+COMPACT_NODES = bool(environ.get('COMMENT_FILTER_COMPACT'))
+EMPTY_NODES = {}  # Tag -> shared `Node` for elements without contents
+
+BLOCK_TAGS = ['<!comment>', '</!comment>', '<!box>', '</!box>',
+              '<center>', '</center>', '<!speaker>', '</!speaker>']
+INLINE_TAGS = ['<comment>', '</comment>', '<highlight>', '</highlight>',
+               '<fixme>', '</fixme>', '<margin>', '</margin>',
+               '<smcaps>', '</smcaps>']
+
+BIBTEX_ENTRY = re_compile(r'@\s*(\w+)\s*([{(])\s*([^,\s{}()]*)')
+BIBTEX_BRACE = re_compile(r'[{}()"]')
+BIBTEX_CROSSREF = re_compile(r'\b(?:crossref|xdata)\s*=\s*[{"]?\s*([^,}"\s]+)',
+                             IGNORECASE)
 
 COLORS = {
     '<!comment>': 'cyan',
@@ -227,6 +259,114 @@ DOCX_TEXT = {
 }
 
 
+class Node(object):
+    # Compact stand-in for a pandoc element `{'t': tag, 'c': contents}`,
+    # created by `load_document` when COMPACT_NODES is set. It supports the
+    # `node['t']`, `node['c']` and `'c' in node` lookups used on elements, so
+    # handlers work on either representation; `walk` knows both. Nodes are
+    # never modified, so they (notably `Space` and `SoftBreak`) can be shared.
+    __slots__ = ('t', 'c')
+
+    def __init__(self, t, c=None):
+        self.t = t
+        self.c = c
+
+    def __getitem__(self, key):
+        if key == 't':
+            return self.t
+        elif key == 'c' and self.c is not None:
+            return self.c
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 't' or (key == 'c' and self.c is not None)
+
+    def __repr__(self):
+        return 'Node({!r}, {!r})'.format(self.t, self.c)
+
+
+def compact_node(obj):
+    # `object_hook` for `json.loads`, turning elements into `Node`s as soon
+    # as they are decoded (so the dicts never all exist at once). Element tags
+    # are always strings; a metadata map with a `t` key holds a meta value
+    # there instead, and is left alone.
+    if 't' not in obj or len(obj) > 2 or (len(obj) == 2 and 'c' not in obj) \
+            or not isinstance(obj['t'], type(u'')):
+        return obj
+    tag = intern_string(obj['t'])
+    if 'c' not in obj:
+        if tag not in EMPTY_NODES:
+            EMPTY_NODES[tag] = Node(tag)
+        return EMPTY_NODES[tag]
+    contents = obj['c']
+    if tag == 'Str':
+        contents = intern_string(contents)
+    return Node(tag, contents)
+
+
+def intern_string(text):
+    # Share equal strings (such as element tags and common words) when
+    # possible.
+    if intern is None:
+        return text
+    return intern(text)
+
+
+def expand_node(node):
+    # `default` for `json.dump`, turning `Node`s back into elements as they
+    # are written out.
+    if isinstance(node, Node):
+        if node.c is None:
+            return {'t': node.t}
+        return {'t': node.t, 'c': node.c}
+    raise TypeError('{!r} is not JSON serializable'.format(node))
+
+
+def load_document(text):
+    if COMPACT_NODES:
+        return json.loads(text, object_hook=compact_node)
+    return json.loads(text)
+
+
+def dump_document(document, stream):
+    # (`json.dumps` rather than `json.dump`, which cannot use the much faster
+    # C encoder.)
+    stream.write(json.dumps(document, default=expand_node))
+
+
+def walk(x, action, format, meta):
+    # Same as `pandocfilters.walk`, but also walks `Node`s.
+    if isinstance(x, list):
+        array = []
+        for item in x:
+            if isinstance(item, (dict, Node)) and 't' in item:
+                res = action(item['t'],
+                             item['c'] if 'c' in item else None, format, meta)
+                if res is None:
+                    array.append(walk(item, action, format, meta))
+                elif isinstance(res, list):
+                    for z in res:
+                        array.append(walk(z, action, format, meta))
+                else:
+                    array.append(walk(res, action, format, meta))
+            else:
+                array.append(walk(item, action, format, meta))
+        return array
+    elif isinstance(x, Node):
+        if not isinstance(x.c, (list, dict, Node)):
+            return x  # Nothing to walk (e.g., `Str`): keep sharing it
+        return Node(x.t, walk(x.c, action, format, meta))
+    elif isinstance(x, dict):
+        return {k: walk(v, action, format, meta) for k, v in x.items()}
+    else:
+        return x
+
+
+def stringify(x):
+    # Same as `pandocfilters.stringify`, but also for `Node`s.
+    return plain_stringify(json.loads(json.dumps(x, default=expand_node)))
+
+
 def debug(text):
     stderr.write("*****\n" + str(text) + "\n*****\n")
 
@@ -235,7 +375,8 @@ def my_sha1(x):
     return sha1(x.encode(getfilesystemencoding())).hexdigest()
 
 
-def tikz2image(tikz, filetype, outfile):
+def tikz2image(tikz, outfile):
+    # Typeset `tikz` into `outfile + '.pdf'`.
     from tempfile import mkdtemp
     tmpdir = mkdtemp()
     olddir = getcwd()
@@ -245,12 +386,73 @@ def tikz2image(tikz, filetype, outfile):
     f.close()
     call(['pdflatex', 'tikz.tex'], stdout=stderr)
     chdir(olddir)
-    if filetype == '.pdf':
-        copyfile(path.join(tmpdir, 'tikz.pdf'), outfile + filetype)
+    copyfile(path.join(tmpdir, 'tikz.pdf'), outfile + '.pdf')
+    rmtree(tmpdir)
+
+
+def pdf2image(outfile, filetype):
+    # Convert `outfile + '.pdf'` into `outfile + filetype`.
+    if filetype == '.svg':
+        call(['pdftocairo', '-svg', outfile + '.pdf', outfile + filetype])
     else:
-        call(['convert', '-density', '300', path.join(tmpdir, 'tikz.pdf'),
+        call(['convert', '-density', '300', outfile + '.pdf',
               '-quality', '100', outfile + filetype])
-    rmtree(tmpdir)
+
+
+def is_tikz(value):
+    # Whether the contents of a CodeBlock are a TikZ figure.
+    (id, classes, attributes), code = value
+    return 'tikz' in classes or '\\begin{tikzpicture}' in code
+
+
+def figure_filetype(docFormat, meta):
+    # LaTeX uses the PDF directly; other formats get a PNG, or an SVG with
+    # `figure-filetype: svg`.
+    if docFormat in ['latex', 'beamer']:
+        return '.pdf'
+    elif 'figure-filetype' in meta and \
+            stringify(meta['figure-filetype']).lower() == 'svg':
+        return '.svg'
+    return '.png'
+
+
+def tikz_figure(value, meta, filetype):
+    # Return the image file for the TikZ figure in CodeBlock contents
+    # `value`. Each figure is typeset only once, into a PDF in IMAGE_PATH;
+    # other file types are converted from that PDF when first needed, and
+    # kept next to it.
+    (id, classes, attributes), code = value
+    if 'fontfamily' in meta:
+        font = meta['fontfamily']['c'][0]['c']
+    else:
+        font = DEFAULT_FONT
+    outfile = path.join(IMAGE_PATH, my_sha1(code + font))
+    sourceFile = outfile + filetype
+    library = ''
+    for a, b in attributes:
+        if a == 'tikzlibrary':
+            library = b
+    if path.isfile(sourceFile):
+        return sourceFile
+    if not path.isfile(outfile + '.pdf'):
+        try:
+            mkdir(IMAGE_PATH)
+            debug('Created directory {}\n\n'.format(IMAGE_PATH))
+        except OSError:
+            pass
+        codeHeader = '\\documentclass{{standalone}}\n' + \
+                     '\\usepackage{{{}}}\n' + \
+                     '\\usepackage{{tikz}}\n'.format(font)
+        if library:
+            codeHeader += '\\usetikzlibrary{{{}}}\n'.format(library)
+        codeHeader += '\\begin{document}\n'
+        codeFooter = '\n\\end{document}\n'
+        tikz2image(codeHeader + code + codeFooter, outfile)
+        debug('Created image {}\n\n'.format(outfile + '.pdf'))
+    if filetype != '.pdf':
+        pdf2image(outfile, filetype)
+        debug('Created image {}\n\n'.format(sourceFile))
+    return sourceFile
 
 
 def toFormat(string, fromThis, toThis):
@@ -262,6 +464,106 @@ def toFormat(string, fromThis, toThis):
     return p2.communicate()[0].decode('utf-8').strip('\n')
 
 
+def format_caption(caption):
+    # Need to run this through pandoc to get JSON representation so that
+    # captions can be formatted text. Results are kept in `CAPTIONS`, since
+    # each call starts a `pandoc` process.
+    if caption not in CAPTIONS:
+        jsonString = toFormat(caption, 'markdown', 'json')
+        if "blocks" in jsonString:
+            CAPTIONS[caption] = eval(jsonString)["blocks"][0]['c']
+        else:  # old API
+            CAPTIONS[caption] = eval(jsonString)[1][0]['c']
+    return CAPTIONS[caption]
+
+
+def bibtex_entries(text):
+    # Split BibTeX `text` into `(key, entry)` pairs, where `key` is `None` for
+    # `@string` and `@preamble` entries. (Anything outside of entries,
+    # including `@comment`s, is left out.) Raises `ValueError` for an entry
+    # whose end cannot be found.
+    position = text.find('@')
+    while position != -1:
+        match = BIBTEX_ENTRY.match(text, position)
+        if not match:
+            position = text.find('@', position + 1)
+            continue
+        kind, opening, key = match.groups()
+        kind = kind.lower()
+        closing = '}' if opening == '{' else ')'
+        depth = 0
+        quoted = False  # Inside a `"`-delimited value (at brace depth 0)
+        end = None
+        for brace in BIBTEX_BRACE.finditer(text, match.start(2) + 1):
+            char = brace.group()
+            if char == '{':
+                depth += 1
+            elif char == '}' and depth:
+                depth -= 1
+            elif char == '"' and not depth and kind != 'comment':
+                quoted = not quoted
+            elif char == closing and not depth and not quoted:
+                end = brace.end()
+                break
+        if end is None:
+            raise ValueError('Cannot find the end of the entry starting '
+                             'with {!r}'.format(match.group()))
+        if kind in ['string', 'preamble']:
+            yield None, text[position:end]
+        elif kind != 'comment':
+            yield key, text[position:end]
+        position = text.find('@', end)
+
+
+def prune_bibliography(filename, citedKeys):
+    # Return a BibTeX file with only the entries of `filename` that are in
+    # `citedKeys` (plus the ones they `crossref`, and all `@string`s). It is
+    # kept in BIBLIOGRAPHY_PATH, and only made again when the keys or the
+    # original file change. Other bibliography formats are left alone.
+    if not filename.lower().endswith('.bib') or not path.isfile(filename):
+        return filename
+    info = stat(filename)
+    prunedFile = path.join(BIBLIOGRAPHY_PATH, my_sha1(u'{}\n{}\n{}\n{}'.format(
+        path.abspath(filename), info.st_mtime, info.st_size,
+        '\n'.join(sorted(citedKeys)))) + '.bib')
+    if path.isfile(prunedFile):
+        return prunedFile
+    try:
+        with io_open(filename, encoding='utf-8') as f:
+            entries = list(bibtex_entries(f.read()))
+    except ValueError as error:  # Including `UnicodeDecodeError`
+        # Better to have citeproc read everything than a broken entry.
+        debug('Not pruning {}: {}\n\n'.format(filename, error))
+        return filename
+    wanted = set(citedKeys)
+    byKey = dict((key, entry) for key, entry in entries if key is not None)
+    new = list(wanted)
+    while new:  # Follow crossrefs (which may have crossrefs of their own)
+        entry = byKey.get(new.pop())
+        if entry:
+            for parent in BIBTEX_CROSSREF.findall(entry):
+                if parent not in wanted:
+                    wanted.add(parent)
+                    new.append(parent)
+    try:
+        makedirs(BIBLIOGRAPHY_PATH)
+        debug('Created directory {}\n\n'.format(BIBLIOGRAPHY_PATH))
+    except OSError:
+        pass
+    # Write to a temporary file first, so that an interrupted build (or
+    # another build running in parallel) never leaves a partial file behind
+    # under the cached name.
+    from tempfile import mkstemp
+    fd, tmpFile = mkstemp(suffix='.tmp', dir=BIBLIOGRAPHY_PATH)
+    with io_open(fd, 'w', encoding='utf-8') as f:
+        f.write(u'\n\n'.join(entry for key, entry in entries
+                             if key is None or key in wanted) + u'\n')
+    rename(tmpFile, prunedFile)
+    debug('Created bibliography {} with {} of {} entries\n\n'.format(
+        prunedFile, len(wanted & set(byKey)), len(byKey)))
+    return prunedFile
+
+
 def latex(text):
     return RawInline('latex', text)
 
@@ -683,46 +985,16 @@ def handle_comments(key, value, docFormat, meta):
 
     # Check for tikz CodeBlock. If it exists, try typesetting figure
     elif key == 'CodeBlock':
-        (id, classes, attributes), code = value
-        if 'tikz' in classes or '\\begin{tikzpicture}' in code:
-            if 'fontfamily' in meta:
-                font = meta['fontfamily']['c'][0]['c']
-            else:
-                font = DEFAULT_FONT
-            outfile = path.join(IMAGE_PATH, my_sha1(code + font))
-            filetype = '.pdf' if docFormat in ['latex', 'beamer'] else '.png'
-            sourceFile = outfile + filetype
+        if is_tikz(value):
+            (id, classes, attributes), code = value
+            sourceFile = tikz_figure(value, meta,
+                                     figure_filetype(docFormat, meta))
             caption = ''
-            library = ''
             for a, b in attributes:
                 if a == 'caption':
                     caption = b
-                elif a == 'tikzlibrary':
-                    library = b
-            if not path.isfile(sourceFile):
-                try:
-                    mkdir(IMAGE_PATH)
-                    debug('Created directory {}\n\n'.format(IMAGE_PATH))
-                except OSError:
-                    pass
-                codeHeader = '\\documentclass{{standalone}}\n' + \
-                             '\\usepackage{{{}}}\n' + \
-                             '\\usepackage{{tikz}}\n'.format(font)
-                if library:
-                    codeHeader += '\\usetikzlibrary{{{}}}\n'.format(library)
-                codeHeader += '\\begin{document}\n'
-                codeFooter = '\n\\end{document}\n'
-                tikz2image(codeHeader + code + codeFooter, filetype,
-                           outfile)
-                debug('Created image {}\n\n'.format(sourceFile))
             if caption:
-                # Need to run this through pandoc to get JSON
-                # representation so that captions can be docFormatted text.
-                jsonString = toFormat(caption, 'markdown', 'json')
-                if "blocks" in jsonString:
-                    formattedCaption = eval(jsonString)["blocks"][0]['c']
-                else:  # old API
-                    formattedCaption = eval(jsonString)[1][0]['c']
+                formattedCaption = format_caption(caption)
             else:
                 formattedCaption = [Str('')]
             return Para([Image((id, classes, attributes), formattedCaption,
@@ -734,31 +1006,276 @@ def handle_comments(key, value, docFormat, meta):
         return
 
 
-def main():
-    # This grabs the output of `pandoc` as json file, retrieves `metadata` to
-    # check for draft status, and runs the document through `handle_comments`.
-    # Then adds any needed entries to `metadata` and passes the output back out
-    # to `pandoc`. This code is modeled after
-    # <https://github.com/aaren/pandoc-reference-filter>.
-    global DRAFT
-    document = json.loads(sys.stdin.read())
-    if len(sys.argv) > 1:
-        format = sys.argv[1]
-    else:
-        format = ''
-
+def structural_tag(node):
+    # Return the block or inline tag represented by `node`, recognized the
+    # same way `handle_comments` recognizes it, or `None`.
+    key = node['t']
+    if key == 'RawBlock':
+        elementFormat, tag = node['c']
+        if elementFormat == 'html' and tag.lower() in BLOCK_TAGS:
+            return tag.lower()
+    elif key == 'Para':
+        value = node['c']
+        if len(value) == 1 and value[0]['t'] == 'Str' and \
+                value[0]['c'] in BLOCK_TAGS:
+            return value[0]['c']
+    elif key == 'RawInline':
+        elementFormat, tag = node['c']
+        if elementFormat == 'html' and tag in INLINE_TAGS:
+            return tag
+    return None
+
+
+def iter_nodes(blocks):
+    # Yield `(blockNumber, node)` for every element, in document order. Uses
+    # an explicit stack so that deeply nested documents neither hit the
+    # recursion limit nor get visited more than once.
+    for blockNumber, block in enumerate(blocks, 1):
+        stack = [block]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(reversed(node))
+            elif isinstance(node, (dict, Node)) and 't' in node:
+                yield blockNumber, node
+                if 'c' in node:
+                    stack.append(node['c'])
+
+
+def iter_tags(blocks):
+    # Yield `(blockNumber, tag)` for every structural tag, in document order.
+    for blockNumber, node in iter_nodes(blocks):
+        tag = structural_tag(node)
+        if tag:
+            yield blockNumber, tag
+
+
+def iter_filtered_nodes(blocks, draft):
+    # Like `iter_nodes`, but yields `(blockNumber, node, tag)` (`tag` being
+    # `structural_tag(node)`) only for what `handle_comments` actually looks
+    # at. Unless in draft, it drops the contents of `<!comment>`, `<comment>`
+    # and `<margin>` unseen, and the comment, `<fixme>` and `<highlight>`
+    # tags themselves without checking how they are nested.
+    blockComment = False
+    inlineComment = False
+    inlineMargin = False
+    for blockNumber, node in iter_nodes(blocks):
+        tag = structural_tag(node)
+        if draft:
+            yield blockNumber, node, tag
+        elif blockComment:
+            if tag == '</!comment>':
+                blockComment = False
+        elif tag in ['<!comment>', '</!comment>']:
+            blockComment = tag == '<!comment>'
+        elif tag in BLOCK_TAGS:
+            yield blockNumber, node, tag
+        elif tag == '<comment>':
+            inlineComment = True
+        elif tag == '<margin>':
+            inlineMargin = True
+        elif inlineComment:
+            if tag == '</comment>':
+                inlineComment = False
+        elif inlineMargin:
+            if tag == '</margin>':
+                inlineMargin = False
+        elif tag not in ['</comment>', '</margin>', '<fixme>', '</fixme>',
+                         '<highlight>', '</highlight>']:
+            yield blockNumber, node, tag
+
+
+def filtered_tags(blocks, draft):
+    # The tags that `handle_comments` would check; see `iter_filtered_nodes`.
+    # (`iter_tags` gives all of them, for `--lint`.)
+    for blockNumber, node, tag in iter_filtered_nodes(blocks, draft):
+        if tag:
+            yield blockNumber, tag
+
+
+def cited_keys(document):
+    # The keys of every citation that can end up in the output: those in the
+    # metadata (such as `nocite`), and those in the text that are not dropped
+    # (see `iter_filtered_nodes`). This is a separate pass, since
+    # `handle_comments` is not called on everything it keeps (e.g., the
+    # contents of a `highlight` span that it returns as they are).
+    metadata = document_metadata(document)
+    citations = [node for _, node in iter_nodes(list(metadata.values()))
+                 if node['t'] == 'Cite']
+    citations += [node for _, node, _ in iter_filtered_nodes(
+        document_blocks(document), is_draft(metadata))
+        if node['t'] == 'Cite']
+    return set(citation['citationId']
+               for node in citations for citation in node['c'][0])
+
+
+def is_draft(metadata):
+    if 'draft' in metadata:
+        return metadata['draft']['c']
+    return False
+
+
+def lint_tags(tags):
+    # Check that all block and inline tags (as given by `iter_tags`) are
+    # properly matched and nested, without rendering anything. Returns a list
+    # of `(blockNumber, message)` for every problem found (not just the first
+    # one).
+    errors = []
+    blockStack = []
+    inlineStack = []
+    for blockNumber, tag in tags:
+        isBlock = tag in BLOCK_TAGS
+        stack = blockStack if isBlock else inlineStack
+        if not tag.startswith('</'):
+            stack.append((blockNumber, tag))
+            continue
+        if isBlock and inlineStack:
+            errors.append((blockNumber, '{} closes a block while inline '
+                           'tags are still open: {}'.format(
+                               tag, ', '.join(t for n, t in inlineStack))))
+            del inlineStack[:]
+        opening = '<' + tag[2:]
+        if not stack:
+            errors.append((blockNumber,
+                           '{} has no matching {}'.format(tag, opening)))
+        elif stack[-1][1] == opening:
+            stack.pop()
+        elif any(t == opening for n, t in stack):
+            # Close everything that was left open inside this element.
+            while stack[-1][1] != opening:
+                openedAt, unclosed = stack.pop()
+                errors.append((openedAt, '{} is not closed before {} '
+                               '(block {})'.format(unclosed, tag,
+                                                   blockNumber)))
+            stack.pop()
+        else:
+            errors.append((blockNumber, '{} does not match opening tag {} '
+                           '(block {})'.format(tag, stack[-1][1],
+                                               stack[-1][0])))
+    for openedAt, unclosed in blockStack + inlineStack:
+        errors.append((openedAt, '{} is never closed'.format(unclosed)))
+    errors.sort(key=lambda error: error[0])
+    return errors
+
+
+def report_lint(errors, blocks, stream=stderr):
+    # Write lint errors as `block N: message` lines, with the beginning of the
+    # offending block so that it can be found in the source.
+    for blockNumber, message in errors:
+        context = stringify(blocks[blockNumber - 1])
+        if len(context) > 40:
+            context = context[:37] + '...'
+        if context:
+            message += u' [{}]'.format(context)
+        stream.write(u'block {}: {}\n'.format(blockNumber, message))
+
+
+def document_blocks(document):
+    if 'blocks' in document:         # new API
+        return document['blocks']
+    return document[1]               # old API
+
+
+def lint():
+    # Standalone lint mode, for editors and pre-commit hooks:
+    #     pandoc -t json report.md | pandocCommentFilter.py --lint
+    document = load_document(sys.stdin.read())
+    blocks = document_blocks(document)
+    errors = lint_tags(iter_tags(blocks))
+    report_lint(errors, blocks)
+    exit(1 if errors else 0)
+
+
+def document_metadata(document):
     if 'meta' in document:           # new API
-        metadata = document['meta']
+        return document['meta']
     elif document[0]:                # old API
-        metadata = document[0]['unMeta']
+        return document[0]['unMeta']
+
+
+def reset_state(metadata):
+    # Start a fresh pass of `handle_comments` over a document.
+    global INLINE_TAG_STACK, BLOCK_COMMENT, INLINE_COMMENT, INLINE_MARGIN,\
+        INLINE_HIGHLIGHT, INLINE_FONT_COLOR_STACK, USED_BOX, DRAFT
+    INLINE_TAG_STACK = []
+    BLOCK_COMMENT = False
+    INLINE_COMMENT = False
+    INLINE_MARGIN = False
+    INLINE_HIGHLIGHT = False
+    INLINE_FONT_COLOR_STACK = ['black']
+    USED_BOX = False
+    DRAFT = is_draft(metadata)
 
-    if 'draft' in metadata:
-        DRAFT = metadata['draft']['c']
-    else:
-        DRAFT = False
 
-    newDocument = document
-    newDocument = walk(newDocument, handle_comments, format, metadata)
+def filter_state():
+    # The part of the state of `handle_comments` that carries over from one
+    # block to the next and affects how the next block is filtered.
+    return (BLOCK_COMMENT, tuple(INLINE_TAG_STACK), INLINE_COMMENT,
+            INLINE_MARGIN, INLINE_HIGHLIGHT, tuple(INLINE_FONT_COLOR_STACK),
+            DRAFT)
+
+
+def restore_filter_state(state):
+    global INLINE_TAG_STACK, BLOCK_COMMENT, INLINE_COMMENT, INLINE_MARGIN,\
+        INLINE_HIGHLIGHT, INLINE_FONT_COLOR_STACK, DRAFT
+    (BLOCK_COMMENT, inlineTags, INLINE_COMMENT, INLINE_MARGIN,
+     INLINE_HIGHLIGHT, fontColors, DRAFT) = state
+    INLINE_TAG_STACK = list(inlineTags)
+    INLINE_FONT_COLOR_STACK = list(fontColors)
+
+
+def filter_blocks(blocks, format, metadata, blockCache):
+    # Same as `walk(blocks, handle_comments, format, metadata)`, except that a
+    # block that was already filtered starting from the same state is taken
+    # from `blockCache` instead of being walked again. `blockCache` is left
+    # holding only the blocks of this document (plus, under the key `None`,
+    # the format and metadata they were filtered for).
+    global USED_BOX
+    context = json.dumps([format, metadata], sort_keys=True,
+                         default=expand_node)
+    if blockCache.get(None) != context:
+        blockCache.clear()
+    usedCache = {None: context}
+    newBlocks = []
+    for block in blocks:
+        key = (json.dumps(block, sort_keys=True, default=expand_node),
+               filter_state())
+        if key in blockCache:
+            cached = blockCache[key]
+        else:
+            usedBox = USED_BOX
+            USED_BOX = False
+            newBlock = walk([block], handle_comments, format, metadata)
+            cached = (newBlock, filter_state(), USED_BOX)
+            USED_BOX = usedBox
+        usedCache[key] = cached
+        newBlock, state, usedBox = cached
+        restore_filter_state(state)
+        USED_BOX = USED_BOX or usedBox
+        newBlocks.extend(newBlock)
+    blockCache.clear()
+    blockCache.update(usedCache)
+    return newBlocks
+
+
+def filter_document(document, format, blockCache=None):
+    # Run the whole document through `handle_comments`, then add any needed
+    # entries to `metadata`. If given, `blockCache` is used (and updated) to
+    # avoid filtering blocks that have not changed since the last call.
+    metadata = document_metadata(document)
+    reset_state(metadata)
+
+    if blockCache is None or 'blocks' not in document:
+        newDocument = walk(document, handle_comments, format, metadata)
+    else:
+        newDocument = {}
+        for key in document:
+            if key == 'blocks':
+                newDocument[key] = filter_blocks(document[key], format,
+                                                 metadata, blockCache)
+            else:
+                newDocument[key] = walk(document[key], handle_comments,
+                                        format, metadata)
 
     # Need to ensure the LaTeX/beamer template knows if `mdframed` package is
     # required (when `<!box>` has been used).
@@ -767,6 +1284,7 @@ def main():
         MetaInlines = elt('MetaInlines', 1)
         rawinlines = [MetaInlines([RawInline('tex',
                                              '\\RequirePackage{mdframed}')])]
+        metadata = dict(metadata)  # Leave `document` untouched
         if 'header-includes' in metadata:
             headerIncludes = metadata['header-includes']
             if headerIncludes['t'] == 'MetaList':
@@ -776,7 +1294,262 @@ def main():
         metadata['header-includes'] = MetaList(rawinlines)
         newDocument['meta'] = metadata
 
-    json.dump(newDocument, sys.stdout)
+    # With `prune-bibliography: true`, have citeproc read only the entries
+    # that are actually cited. (Not possible when everything is cited with
+    # `nocite: '@*'`.)
+    metadata = document_metadata(newDocument)
+    prune = format != 'markdown' and 'meta' in newDocument and \
+        'bibliography' in metadata and \
+        'prune-bibliography' in metadata and \
+        metadata['prune-bibliography']['c']
+    citedKeys = cited_keys(document) if prune else set()
+    if prune and '*' not in citedKeys:
+        MetaList = elt('MetaList', 1)
+        MetaString = elt('MetaString', 1)
+        metadata = dict(metadata)
+        bibliography = metadata['bibliography']
+        if bibliography['t'] == 'MetaList':
+            bibliography = bibliography['c']
+        else:
+            bibliography = [bibliography]
+        metadata['bibliography'] = MetaList(
+            [MetaString(prune_bibliography(stringify(item), citedKeys))
+             for item in bibliography])
+        newDocument['meta'] = metadata
+
+    return newDocument
+
+
+def pandoc(arguments, input=None):
+    # Run `pandoc` with `arguments`, feeding it `input` (if any); return its
+    # output, or `None` (after reporting the error) if it failed.
+    p = Popen(['pandoc'] + arguments, stdin=PIPE, stdout=PIPE)
+    output = p.communicate(input.encode('utf-8') if input else None)[0]
+    if p.returncode:
+        debug('pandoc {} failed with exit status {}'.format(
+            ' '.join(arguments), p.returncode))
+        return None
+    return output.decode('utf-8')
+
+
+def modification_times(paths):
+    times = {}
+    for filename in paths:
+        try:
+            times[filename] = stat(filename).st_mtime
+        except OSError:
+            times[filename] = None
+    return times
+
+
+def watch(arguments):
+    # Rebuild OUTPUT from the INPUT files whenever they, a file named in the
+    # pandoc options (templates, CSL style, ...) or the bibliography change:
+    #
+    #     pandocCommentFilter.py --watch OUTPUT INPUT... [-- PANDOC-OPTION...]
+    #
+    # The INPUT files are only parsed again when one of them has changed, and
+    # only blocks that changed (or that follow a change in the tag state) are
+    # filtered again; TikZ figures are looked up only for those blocks, and
+    # captions are only converted once. Options for reading (`--from`) are
+    # passed to the parsing pandoc, all others to the rendering pandoc.
+    if '--' in arguments:
+        split = arguments.index('--')
+        arguments, options = arguments[:split], arguments[split + 1:]
+    else:
+        options = []
+    if len(arguments) < 2:
+        stderr.write('usage: pandocCommentFilter.py --watch OUTPUT INPUT... '
+                     '[-- PANDOC-OPTION...]\n')
+        exit(2)
+    output, inputs = arguments[0], arguments[1:]
+    readerOptions = []
+    writerOptions = []
+    options = iter(options)
+    for option in options:
+        if option in ['-f', '-r', '--from', '--read']:
+            readerOptions += [option, next(options)]
+        elif option.startswith('--from=') or option.startswith('--read='):
+            readerOptions.append(option)
+        else:
+            writerOptions.append(option)
+    extension = path.splitext(output)[1]
+    format = WATCH_FORMATS.get(extension, extension[1:])
+    # Files that only affect rendering, not parsing or filtering
+    renderFiles = [option for option in writerOptions if path.isfile(option)]
+
+    document = None
+    reparse = False  # Whether the last attempt to parse INPUTs failed
+    blockCache = {}
+    watched = modification_times(inputs + renderFiles)
+    changed = set(watched)
+    while True:
+        if not changed:
+            sleep(WATCH_INTERVAL)
+        else:
+            # Wait for a burst of saves to settle down before rebuilding.
+            while True:
+                sleep(WATCH_DEBOUNCE)
+                times = modification_times(watched)
+                settling = set(f for f in times if times[f] != watched[f])
+                watched = times
+                if not settling:
+                    break
+                changed |= settling
+
+            start = time()
+            try:
+                # Only keep a newly parsed document once it has been
+                # filtered, so that a broken save leaves the last good
+                # state (and an unchanged `blockCache`) behind.
+                current = document
+                if current is None or reparse or changed & set(inputs):
+                    reparse = True
+                    jsonString = pandoc(inputs + readerOptions +
+                                        ['-t', 'json'])
+                    if jsonString:
+                        current = load_document(jsonString)
+                    else:
+                        current = None
+                parsed = time()
+                errors = []
+                if current is not None:
+                    blocks = document_blocks(current)
+                    errors = lint_tags(filtered_tags(
+                        blocks, is_draft(document_metadata(current))))
+                    report_lint(errors, blocks)
+                if current is not None and not errors:
+                    cached = set(blockCache)
+                    newDocument = filter_document(current, format,
+                                                  blockCache)
+                    document = current
+                    reparse = False
+                    refiltered = len(set(blockCache) - cached - set([None]))
+                    filtered = time()
+                    rendered = pandoc(writerOptions + ['-f', 'json',
+                                                       '-o', output],
+                                      json.dumps(newDocument,
+                                                 default=expand_node))
+                    if rendered is not None:
+                        stderr.write('{}: rebuilt in {:.2f}s (parse {:.2f}s, '
+                                     'filter {:.2f}s for {} of {} blocks, '
+                                     'render {:.2f}s)\n'.format(
+                                         output, time() - start,
+                                         parsed - start, filtered - parsed,
+                                         refiltered, len(blocks),
+                                         time() - filtered))
+                    metadata = document_metadata(document)
+                    if 'bibliography' in metadata:
+                        bibliography = metadata['bibliography']
+                        if bibliography['t'] == 'MetaList':
+                            bibliography = bibliography['c']
+                        else:
+                            bibliography = [bibliography]
+                        for item in bibliography:
+                            filename = stringify(item)
+                            if filename not in watched:
+                                watched.update(
+                                    modification_times([filename]))
+            except (Exception, SystemExit) as error:
+                # E.g., a half-written TikZ figure that does not typeset:
+                # report it, and wait for the next save.
+                debug('Rebuilding {} failed: {!r}'.format(output, error))
+        times = modification_times(watched)
+        changed = set(f for f in times if times[f] != watched[f])
+        watched = times
+
+
+def prepare_targets(document, formats):
+    # Do the format-independent work for all of `formats` in one scan of the
+    # document: check the tag structure, and typeset every TikZ figure (in
+    # each file type needed) and convert its caption, so that filtering for
+    # each format only finds them in the caches. Returns the lint errors;
+    # if there are any, no figures are typeset.
+    metadata = document_metadata(document)
+    filetypes = set(figure_filetype(format, metadata) for format in formats
+                    if format != 'markdown')
+    tags = []
+    figures = []
+    for blockNumber, node, tag in iter_filtered_nodes(
+            document_blocks(document), is_draft(metadata)):
+        if tag:
+            tags.append((blockNumber, tag))
+        elif node['t'] == 'CodeBlock' and is_tikz(node['c']):
+            figures.append(node['c'])
+    errors = lint_tags(tags)
+    if not errors:
+        for value in figures:
+            for filetype in filetypes:
+                tikz_figure(value, metadata, filetype)
+            for a, b in value[0][2]:
+                if a == 'caption' and b:
+                    format_caption(b)
+    return errors
+
+
+def targets(arguments):
+    # Filter one document for several output formats, reading and checking
+    # it (and typesetting its figures) only once:
+    #
+    #     pandoc -t json report.md | pandocCommentFilter.py --targets \
+    #         latex=report.latex.json html5=report.html5.json docx=-
+    #
+    # Each argument is FORMAT[=FILE]; FILE defaults to FORMAT.json, and `-`
+    # means standard output. Each result can then be rendered with
+    # `pandoc -f json FILE ...`.
+    outputs = []
+    for argument in arguments:
+        format, _, filename = argument.partition('=')
+        outputs.append((format, filename or format + '.json'))
+    document = load_document(sys.stdin.read())
+    errors = prepare_targets(document, [format for format, _ in outputs])
+    if errors:
+        report_lint(errors, document_blocks(document))
+        exit(1)
+    for format, filename in outputs:
+        newDocument = filter_document(document, format)
+        if filename == '-':
+            dump_document(newDocument, sys.stdout)
+            sys.stdout.write('\n')
+        else:
+            with open(filename, 'w') as f:
+                dump_document(newDocument, f)
+    exit(0)
+
+
+def main():
+    # This grabs the output of `pandoc` as json file, retrieves `metadata` to
+    # check for draft status, and runs the document through `handle_comments`.
+    # Then adds any needed entries to `metadata` and passes the output back out
+    # to `pandoc`. This code is modeled after
+    # <https://github.com/aaren/pandoc-reference-filter>.
+    if len(sys.argv) > 1 and sys.argv[1] == '--lint':
+        lint()
+    if len(sys.argv) > 1 and sys.argv[1] == '--targets':
+        targets(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == '--watch':
+        try:
+            watch(sys.argv[2:])
+        except KeyboardInterrupt:
+            exit(0)
+    document = load_document(sys.stdin.read())
+    if len(sys.argv) > 1:
+        format = sys.argv[1]
+    else:
+        format = ''
+
+    # Check the tag structure before doing anything expensive (such as
+    # typesetting TikZ figures), so that a broken document fails right away
+    # and with every problem listed.
+    if format != 'markdown':
+        blocks = document_blocks(document)
+        errors = lint_tags(filtered_tags(
+            blocks, is_draft(document_metadata(document))))
+        if errors:
+            report_lint(errors, blocks)
+            exit(1)
+
+    dump_document(filter_document(document, format), sys.stdout)
 
 
 if __name__ == '__main__':